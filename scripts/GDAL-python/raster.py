@@ -6,6 +6,7 @@ __email__ = "lmartisa@gmail.com"
 
 import numpy as np
 from shapefile import *
+import rasteraccess
 import matplotlib.pyplot as plt
 
 
@@ -104,15 +105,19 @@ def Pixel2World(geoMatrix, cols, rows):
     return xLeft, xRight, yTop, yBottom
 
 
-def readraster(pathimg, array = False):
+def readraster(pathimg, array = False, cache = True):
     """
     Opens a raster file and returns its geotransform and projection information.
     If the optional argument `array` is set to `True`, the function also returns
-    the raster data as a NumPy array.
+    the raster data as a NumPy array. By default the dataset comes from the shared
+    cache of rasteraccess, so it is only opened once and stays open. With `cache`
+    set to `False` the raster is opened on its own and closed when the caller drops
+    the returned dataset, for one-off reads such as the metadata of whole scenes.
     
     Args:
     - pathimg: str, the path to the raster file to be opened
     - array: bool, optional argument indicating whether or not to return raster data as a NumPy array
+    - cache: bool, optional argument indicating whether or not to use the shared cache of datasets
     
     Returns:
     - If `array` is False, returns a tuple containing the following items:
@@ -125,14 +130,24 @@ def readraster(pathimg, array = False):
         - proj: str, string containing projection information
         - img: gdal.Dataset, GDAL dataset object representing the opened raster file
     """
-    img = gdal.Open(pathimg)
-    if img is None:
-        print ('Unable to open %s' % pathimg)
-        sys.exit(1)
-    geoTrans = img.GetGeoTransform()
-    proj = img.GetProjection()
+    if not cache:
+        img = gdal.Open(pathimg)
+        if img is None:
+            print ('Unable to open %s' % pathimg)
+            sys.exit(1)
+        geoTrans = img.GetGeoTransform()
+        proj = img.GetProjection()
+        if array:
+            array = img.ReadAsArray()
+            return array, geoTrans, proj, img
+        return geoTrans, proj, img
+
+    handle = rasteraccess.open_raster(pathimg)
+    img = handle.dataset
+    geoTrans = handle.geoTrans
+    proj = handle.proj
     if array:
-        array = img.ReadAsArray()
+        array = handle.read()
         return array, geoTrans, proj, img
     else:
         return geoTrans, proj, img
@@ -186,6 +201,38 @@ def emptyrast(outname,geoTrans, proj, shape):
     return dataset
 
 
+def savecompressed(outname, bands, geoTrans, proj, nodata = None):
+    '''
+    Saves a list of 2D arrays as the bands of a tiled and compressed GeoTIFF.
+
+    Args:
+    - outname: str, full path and name (without extension) for the output raster file
+    - bands: list of np.ndarray, one 2D array (rows, cols) per band, all with the same shape
+    - geoTrans: tuple, six-element tuple containing geotransform matrix information
+    - proj: str, string containing projection information
+    - nodata: float, optional nodata value set on every band
+
+    Returns:
+    - None
+
+    Note: The output raster file will be saved in GeoTIFF format with a data type of Float32
+    and DEFLATE compression.
+    '''
+    rows, cols = bands[0].shape
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(outname + '.tif', cols, rows, len(bands), gdal.GDT_Float32,
+                            ['COMPRESS=DEFLATE', 'PREDICTOR=3', 'TILED=YES'])
+    for i, band in enumerate(bands):
+        outband = dataset.GetRasterBand(i + 1)
+        outband.WriteArray(band)
+        if nodata is not None:
+            outband.SetNoDataValue(nodata)
+    dataset.SetGeoTransform(geoTrans)
+    dataset.SetProjection(proj)
+    dataset.FlushCache()
+    dataset = None
+
+
 
 def GetPointsRaster(dataSource):
     """
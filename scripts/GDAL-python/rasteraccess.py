@@ -0,0 +1,261 @@
+__author__ = "Laura Martinez Sanchez"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "lmartisa@gmail.com"
+
+from osgeo import gdal
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import threading
+import sys
+
+# Shared raster access for the processing scripts. A tile is opened once and kept in a
+# LRU of open GDAL datasets, the handles only read the metadata until pixels are asked
+# for, and ordered lists of tiles can be read ahead by a small pool of threads.
+
+
+class DatasetCache(object):
+    """
+    LRU cache of open GDAL datasets. Every dataset has its own lock, since a GDAL
+    dataset can not be read from two threads at the same time, while different
+    datasets can be read in parallel.
+
+    Args:
+        maxsize (int): Maximum number of datasets kept open.
+    """
+
+    def __init__(self, maxsize = 128):
+        self.maxsize = maxsize
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Returns the open dataset of a raster and its lock, opening it if needed.
+
+        Args:
+            path (str): Path to the raster.
+
+        Returns:
+            gdal.Dataset, threading.Lock
+        """
+        with self._lock:
+            if path in self._datasets:
+                self._datasets.move_to_end(path)
+                return self._datasets[path]
+            try:
+                dataset = gdal.Open(path)
+            except RuntimeError:
+                dataset = None
+            if dataset is None:
+                print('Unable to open %s' % path)
+                sys.exit(1)
+            self._datasets[path] = (dataset, threading.Lock())
+            while len(self._datasets) > self.maxsize:
+                self._datasets.popitem(last=False)
+            return self._datasets[path]
+
+    def evict(self, path):
+        """
+        Closes the dataset of a raster, to be called before moving or removing the file.
+
+        Args:
+            path (str): Path to the raster.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._datasets.pop(path, None)
+
+    def clear(self):
+        """
+        Closes all the datasets.
+        """
+        with self._lock:
+            self._datasets.clear()
+
+
+_cache = DatasetCache()
+
+
+class RasterHandle(object):
+    """
+    Lazy handle to a raster. Creating it does not open the file, the metadata is read
+    the first time it is needed and the pixels only by read.
+
+    Args:
+        path (str): Path to the raster.
+        cache (DatasetCache): Cache of open datasets, the shared one by default.
+    """
+
+    def __init__(self, path, cache = None):
+        self.path = path
+        self.cache = cache if cache is not None else _cache
+        self._meta = None
+
+    @property
+    def dataset(self):
+        """
+        gdal.Dataset: The open dataset, from the cache.
+        """
+        return self.cache.get(self.path)[0]
+
+    def _metadata(self):
+        if self._meta is None:
+            dataset, lock = self.cache.get(self.path)
+            with lock:
+                self._meta = {'geoTrans': dataset.GetGeoTransform(),
+                              'proj': dataset.GetProjection(),
+                              'width': dataset.RasterXSize,
+                              'height': dataset.RasterYSize,
+                              'count': dataset.RasterCount}
+        return self._meta
+
+    @property
+    def geoTrans(self):
+        return self._metadata()['geoTrans']
+
+    @property
+    def proj(self):
+        return self._metadata()['proj']
+
+    @property
+    def width(self):
+        return self._metadata()['width']
+
+    @property
+    def height(self):
+        return self._metadata()['height']
+
+    @property
+    def count(self):
+        return self._metadata()['count']
+
+    @property
+    def shape(self):
+        """
+        tuple: (bands, rows, cols), as the array returned by read.
+        """
+        return self.count, self.height, self.width
+
+    def read(self, window = None, bands = None, buf_size = None, resample_alg = gdal.GRIORA_NearestNeighbour):
+        """
+        Reads the pixels of the raster, or of a window and a subset of its bands.
+
+        Args:
+            window (tuple): Optional (xoff, yoff, xsize, ysize) in pixels.
+            bands (list): Optional list of bands to read, starting at 1.
+            buf_size (tuple): Optional (cols, rows) to read the window resampled,
+                GDAL uses the overviews when available.
+            resample_alg (int): GDAL resampling used with buf_size, e.g. gdal.GRIORA_Average.
+
+        Returns:
+            numpy array: (rows, cols) for one band rasters or if bands is an int,
+            (bands, rows, cols) otherwise, as gdal ReadAsArray.
+        """
+        xoff, yoff, xsize, ysize = window if window is not None else (0, 0, self.width, self.height)
+        buf_xsize, buf_ysize = buf_size if buf_size is not None else (None, None)
+        dataset, lock = self.cache.get(self.path)
+        with lock:
+            if bands is None:
+                return dataset.ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize = buf_xsize, buf_ysize = buf_ysize,
+                                           resample_alg = resample_alg)
+            if isinstance(bands, int):
+                return dataset.GetRasterBand(bands).ReadAsArray(xoff, yoff, xsize, ysize,
+                                                                buf_xsize = buf_xsize, buf_ysize = buf_ysize,
+                                                                resample_alg = resample_alg)
+            return np.stack([dataset.GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize,
+                                                                     buf_xsize = buf_xsize, buf_ysize = buf_ysize,
+                                                                     resample_alg = resample_alg)
+                             for band in bands])
+
+
+def open_raster(path):
+    """
+    Returns a lazy handle to a raster that uses the shared cache of datasets.
+
+    Args:
+        path (str): Path to the raster.
+
+    Returns:
+        RasterHandle
+    """
+    return RasterHandle(path)
+
+
+def evict(path):
+    """
+    Closes the raster in the shared cache, to be called before moving or removing it.
+
+    Args:
+        path (str): Path to the raster.
+
+    Returns:
+        None
+    """
+    _cache.evict(path)
+
+
+def _read(path):
+    return open_raster(path).read()
+
+
+def read_bgr(path):
+    """
+    Reads a raster as cv2.imread does for the detector, but with the shared cache so
+    the dataset stays open for the georeferencing of the detections. Single band
+    rasters are repeated to three channels, only the first three bands are kept and
+    16 bit values are scaled to 8 bit.
+
+    Args:
+        path (str): Path to the raster.
+
+    Returns:
+        numpy array: (rows, cols, 3) uint8 array in BGR order.
+    """
+    handle = open_raster(path)
+    if handle.count < 3:
+        array = handle.read(bands = 1)
+        array = np.stack([array, array, array])
+    else:
+        array = handle.read(bands = [3, 2, 1])
+    if array.dtype == np.uint16:
+        array = array >> 8
+    return np.ascontiguousarray(array.transpose(1, 2, 0).astype(np.uint8))
+
+
+def read_ahead(paths, reader = None, workers = 4, depth = 8):
+    """
+    Reads an ordered list of rasters with a pool of threads that keeps up to depth
+    rasters read in advance, while the caller processes the current one.
+
+    Args:
+        paths (list): Paths to the rasters, in the order they are needed.
+        reader (function): Function that reads a path, by default all the bands
+            with the shared cache. read_bgr gives the input of the detector.
+        workers (int): Number of threads.
+        depth (int): Maximum number of rasters read and not yet processed.
+
+    Returns:
+        generator: (path, array) in the order of paths.
+    """
+    reader = reader if reader is not None else _read
+    paths = list(paths)
+    executor = ThreadPoolExecutor(max_workers = workers)
+    pending = []
+    try:
+        for path in paths[:depth]:
+            pending.append(executor.submit(reader, path))
+        for i, path in enumerate(paths):
+            result = pending[i].result()
+            pending[i] = None
+            if i + depth < len(paths):
+                pending.append(executor.submit(reader, paths[i + depth]))
+            yield path, result
+    finally:
+        for future in pending:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait = True)
@@ -5,7 +5,7 @@ __email__ = "lmartisa@gmail.com"
 
 
 from osgeo import osr, ogr, gdal
-import os, raster, sys
+import os, raster, rasteraccess, sys
 
 
 def openshp(shapePath, type):
@@ -32,6 +32,29 @@ def openshp(shapePath, type):
     return layer, driver, dataSource
 
 
+def CreateResultFields(layer):
+    """
+    Creates the fields of the detections layer, or adds the ones missing in a layer
+    created by an older version. The string fields get the maximum width of the
+    shapefile format, with the default of 80 characters the paths get truncated.
+
+    Args:
+        layer (ogr.Layer): Layer of the detections.
+
+    Returns:
+        None
+    """
+    layerDefn = layer.GetLayerDefn()
+    for name, fieldtype in [("submitname", ogr.OFTString), ("weightname", ogr.OFTString),
+                            ("proba", ogr.OFTReal), ("tile", ogr.OFTString)]:
+        if layerDefn.GetFieldIndex(name) >= 0:
+            continue
+        new_field = ogr.FieldDefn(name, fieldtype)
+        if fieldtype == ogr.OFTString:
+            new_field.SetWidth(254)
+        layer.CreateField(new_field)
+
+
 def ArrayToPoly(pathimg, control, outname, submit_dir, weights_path, probas):
     """
     First save the array in a raster and then does the polygonization
@@ -45,16 +68,16 @@ def ArrayToPoly(pathimg, control, outname, submit_dir, weights_path, probas):
     weights_path (str): The path to the weights
     probas (numpy.ndarray): The probabilities of the polygons
 
+    The name of the tile is saved with every polygon, so the detections of a tile
+    can be replaced when it is processed again.
+
     Returns:
     None
     """
     
-    img = gdal.Open(pathimg)
-    if img is None:
-        print ('Unable to open %s' % pathimg)
-        sys.exit(1)
-    geoTrans = img.GetGeoTransform()
-    proj = img.GetProjection()
+    img = rasteraccess.open_raster(pathimg)
+    geoTrans = img.geoTrans
+    proj = img.proj
     driver = gdal.GetDriverByName('MEM')
     
     dataset = driver.Create('', control.shape[1], control.shape[0], 1, gdal.GDT_UInt16)
@@ -77,13 +100,7 @@ def ArrayToPoly(pathimg, control, outname, submit_dir, weights_path, probas):
         srs = osr.SpatialReference()
         srs.ImportFromWkt(proj)
         dst_layer = dst_ds.CreateLayer('results', srs = srs, geom_type = ogr.wkbMultiPolygon)
-        
-        new_field = ogr.FieldDefn("submitname", ogr.OFTString)
-        dst_layer.CreateField(new_field)
-        new_field = ogr.FieldDefn("weightname", ogr.OFTString)
-        dst_layer.CreateField(new_field)
-        new_field = ogr.FieldDefn("proba", ogr.OFTReal)
-        dst_layer.CreateField(new_field)
+    CreateResultFields(dst_layer)
 
     drvMEM = ogr.GetDriverByName("MEMORY")
     dst_ds_pol = drvMEM.CreateDataSource('MemData')
@@ -106,6 +123,7 @@ def ArrayToPoly(pathimg, control, outname, submit_dir, weights_path, probas):
         outFeature.SetField('proba', probas[count].item())
         outFeature.SetField('submitname', submit_dir)
         outFeature.SetField('weightname', weights_path)
+        outFeature.SetField('tile', os.path.basename(pathimg))
         outFeature.SetGeometry(feature.GetGeometryRef())
         #Not SetFeature in layer that does not has that feature, but create a new feature!
         dst_layer.CreateFeature(outFeature)
@@ -9,6 +9,9 @@ from osgeo import gdal
 import sys
 import csv
 import os
+syspath = "{}/code/scripts/GDAL-python".format(os.environ['DIR'])
+sys.path.append(syspath)
+import rasteraccess
 import shutil
 import multiprocessing as mp
 
@@ -40,13 +43,10 @@ def erase_empty(file):
     print(file)
     
     if os.path.isfile(file): 
+        img = rasteraccess.open_raster(file)
+        src_ds = img.dataset
         try:
-            src_ds = gdal.Open(file)
-        except:
-            print('Unable to open {}'.format(file))
-            sys.exit(1)
-        try:
-            band_num = src_ds.RasterCount
+            band_num = img.count
         except:
             # for example, try GetRasterBand(10)
             print('{} bands found :('.format(band_num))
@@ -63,6 +63,9 @@ def erase_empty(file):
             minv = minv+stats[0]
             maxv = maxv+stats[1] 
 
+        # close the tile before it is removed or moved
+        src_ds = None
+        rasteraccess.evict(file)
         if minv==0.0 and maxv==0.0:
             remove = file[:-3]
             print("File {} removed. No data on the raster".format(file))
@@ -9,6 +9,7 @@ syspath = "{}/code/scripts/GDAL-python".format(os.environ['DIR'])
 sys.path.append(syspath)
 import shapefile
 import raster
+import rasteraccess
 from shutil import copy2
 import time
 import multiprocessing as mp
@@ -29,10 +30,10 @@ else:
 
 def create_image_part(img, name, image_id):
     """
-    Create a dictionary representing an image and its ID, given the image array, name, and ID.
+    Create a dictionary representing an image and its ID, given the image handle, name, and ID.
     
     Args:
-        img (numpy array): The image as a numpy array.
+        img (rasteraccess.RasterHandle): The image handle, only its size is read.
         name (str): The name of the image file.
         image_id (int): The unique identifier of the image.
         
@@ -42,8 +43,8 @@ def create_image_part(img, name, image_id):
     
     image = {
         'id': image_id,
-        'width': img.shape[0],
-        'height': img.shape[1],
+        'width': img.width,
+        'height': img.height,
         'file_name': name,
         'license': 0,
         "flickr_url": "",
@@ -52,6 +53,78 @@ def create_image_part(img, name, image_id):
     }
     return image, image_id
 
+def load_json(list_files, json_f = json_f, outpathwith = outpathwith):
+    """
+    Loads the images and annotations of a previous run, so a run over new tiles adds
+    them to the dataset instead of replacing it. Images that are in the list of tiles
+    to preprocess, or that are no longer in outpathwith, are dropped with their annotations.
+    
+    Args:
+        list_files (set): Paths of the tiles to preprocess in this run.
+        json_f (str): Path to the json in COCO format.
+        outpathwith (str): Folder of the images with annotations.
+        
+    Returns:
+        img_id, annotation_id, images, annotations: The next free ids and the kept lists.
+    """
+    
+    if not os.path.exists(json_f):
+        return 0, 0, [], []
+    with open(json_f) as json_file:
+        res_dict = json.load(json_file)
+    names = {os.path.basename(file) for file in list_files}
+    images = [image for image in res_dict['images'] if image['file_name'] not in names and
+              os.path.exists(os.path.join(outpathwith, image['file_name']))]
+    ids = {image['id'] for image in images}
+    annotations = [annotation for annotation in res_dict['annotations'] if annotation['image_id'] in ids]
+    img_id = max([image['id'] for image in res_dict['images']], default = -1) + 1
+    annotation_id = max([annotation['id'] for annotation in res_dict['annotations']], default = -1) + 1
+    print("{} images and {} annotations kept from {}".format(len(images), len(annotations), json_f))
+    return img_id, annotation_id, images, annotations
+
+def write_json(images, annotations, json_f = json_f):
+    """
+    Writes the images and annotations as a json in COCO format.
+    
+    Args:
+        images (list): Image dictionaries.
+        annotations (list): Annotation dictionaries.
+        json_f (str): Path to the json.
+        
+    Returns:
+        None
+    """
+    
+    res_dict = {"licenses": [{"name": "Swalim project", "id": 0, "url": ""}],
+            "info": {"contributor": "", "date_created": "", "description": "", "url": "", "version": "", "year": ""},
+            "categories": [{"id": 1,"name": "kiln","supercategory": ""}],
+            "images": images,
+            "annotations": annotations}
+
+    with open(json_f,'w') as outfile:
+        json.dump(res_dict, outfile)
+
+def move_tile(file, outpath, otherpath):
+    """
+    Moves a tile to its output folder. A scene tiled again gives tiles with the same
+    names, so the previous copy of the tile is removed from both output folders first.
+    
+    Args:
+        file (str): Path to the tile.
+        outpath (str): Folder where the tile goes.
+        otherpath (str): The other output folder, where an old copy may be left.
+        
+    Returns:
+        None
+    """
+    
+    basename = os.path.basename(file)
+    for path in [outpath, otherpath]:
+        old = os.path.join(path, basename)
+        if os.path.exists(old):
+            os.remove(old)
+    shutil.move(file, outpath)
+
 def preprocessshape(file, img_id, annotation_id, images, annotations, outpathwith = outpathwith, outpathwithout = outpathwithout, shpname = shpname):
     """
     This function is used to preprocess a raster file and a corresponding shapefile containing object polygons. 
@@ -70,25 +143,27 @@ def preprocessshape(file, img_id, annotation_id, images, annotations, outpathwit
         
     if file.endswith(".tif"):
         basename = os.path.basename(file)
-        array, geoTran, proj, datasource = raster.readraster(file, True)
+        img = rasteraccess.open_raster(file)
+        geoTran = img.geoTrans
         
         # open shp with the objects       
         layer, driver, dataSource = shapefile.openshp(shpname, 0)
         
         # Check the geometry is inside the bbox of the raster
-        xLeft, xRight, yTop, yBottom = raster.GetPointsRaster(datasource)
+        xLeft, xRight, yTop, yBottom = raster.GetPointsRaster(img.dataset)
         rastextend = raster.BBoxAsgeom(xLeft, xRight, yTop, yBottom)
         
         #check the spatial with mask or not mask
         layer.SetSpatialFilter(rastextend)
+        rasteraccess.evict(file)
         if layer.GetFeatureCount() == 0:
-            shutil.move(file, outpathwithout)
+            move_tile(file, outpathwithout, outpathwith)
             
             
         else:
-            image, img_id = create_image_part(array, basename, img_id)
+            image, img_id = create_image_part(img, basename, img_id)
             #append the image to the images json list
-            shutil.move(file, outpathwith)
+            move_tile(file, outpathwith, outpathwithout)
             images.append(image)
             for feature in layer:
                 geom = feature.GetGeometryRef()
@@ -138,14 +213,7 @@ def preprocessshape(file, img_id, annotation_id, images, annotations, outpathwit
             layer.ResetReading()
             img_id +=1 
             
-            res_dict = {"licenses": [{"name": "Swalim project", "id": 0, "url": ""}],
-                    "info": {"contributor": "", "date_created": "", "description": "", "url": "", "version": "", "year": ""},
-                    "categories": [{"id": 1,"name": "kiln","supercategory": ""}],
-                    "images": images,
-                    "annotations": annotations}
-        
-            with open(json_f,'w') as outfile:
-                json.dump(res_dict, outfile)
+            write_json(images, annotations)
                 
     return img_id, annotation_id, images, annotations
  
@@ -156,12 +224,10 @@ def main():
     with open(inpath, 'r') as f:
         list_files = {line.strip() for line in f}
         
-    images=[]
-    annotations=[]
-    img_id = 0
-    annotations_id = 0
+    img_id, annotations_id, images, annotations = load_json(list_files)
     for f in list_files:
         img_id, annotations_id, images, annotations = preprocessshape(f, img_id, annotations_id, images, annotations)
+    write_json(images, annotations)
 
     end = time.time()
     print("Finish!!! :). Execution time: {}".format(end - start))
@@ -0,0 +1,541 @@
+__author__ = "Laura Martinez Sanchez"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "lmartisa@gmail.com"
+
+import sys
+import os
+syspath = "{}/code/scripts/GDAL-python".format(os.environ['DIR'])
+sys.path.append(syspath)
+import shapefile
+import raster
+from osgeo import osr, ogr, gdal
+import numpy as np
+import argparse
+import hashlib
+import glob
+import json
+import re
+import time
+
+# Change detection over the inputs of the chain, so a new delivery of scenes or a new
+# model only triggers the processing of the tiles that changed.
+#
+# The catalog is a json file with:
+#     scenes: {scene path: {size, mtime, checksum, footprint, acquired}}
+#     removed: scenes that were in the catalog and are not in the last scan
+#     pending: {scenes, removed} found by the last scan and not yet accepted
+#     models: {config path: {weights, sha256}}
+#     processed: {config path: {output shapefile: {sha256, tiles: {tile name: scene checksum}}}}
+#     screened: {prefilter path: {sha256, tiles: {tile name: {checksum, score}}}}, the tiles
+#         skipped by prefilter.py
+#
+# A tile is matched to its scene by name, maketiles.sh names the tiles as
+# <scene name>_<row>_<column>.tif
+
+
+def file_checksum(path, blocksize = 1 << 20):
+    """
+    Computes the sha256 of a file reading it by blocks.
+
+    Args:
+        path (str): Path to the file.
+        blocksize (int): Number of bytes read at a time.
+
+    Returns:
+        str: Hexadecimal sha256 of the file.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def acquisition_date(path, dataset):
+    """
+    Gets the acquisition date of a scene from the TIFF metadata or, if not present,
+    from a date written in the file name (YYYYMMDD, YYYY-MM-DD or YYYY_MM_DD).
+
+    Args:
+        path (str): Path to the scene.
+        dataset (gdal.Dataset): The opened scene.
+
+    Returns:
+        str: Date as YYYY-MM-DD or None if it can not be found.
+    """
+    date = dataset.GetMetadataItem('TIFFTAG_DATETIME')
+    if date:
+        return date[:10].replace(':', '-')
+    match = re.search(r'((?:19|20)\d{2})[-_]?(0[1-9]|1[0-2])[-_]?(0[1-9]|[12]\d|3[01])', os.path.basename(path))
+    if match:
+        return '-'.join(match.groups())
+    return None
+
+
+def scene_footprint(path):
+    """
+    Computes the footprint of a scene in EPSG:4326, as gdaltindex does for the tiles.
+
+    Args:
+        path (str): Path to the scene.
+
+    Returns:
+        footprint (str): WKT of the footprint polygon.
+        acquired (str): Acquisition date of the scene, see acquisition_date.
+    """
+    geoTrans, proj, img = raster.readraster(path, cache = False)
+    xLeft, xRight, yTop, yBottom = raster.GetPointsRaster(img)
+    geom = raster.BBoxAsgeom(xLeft, xRight, yTop, yBottom)
+
+    src = osr.SpatialReference()
+    src.ImportFromWkt(proj)
+    dst = osr.SpatialReference()
+    dst.ImportFromEPSG(4326)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    geom.Transform(osr.CoordinateTransformation(src, dst))
+    acquired = acquisition_date(path, img)
+    img = None
+    return geom.ExportToWkt(), acquired
+
+
+def load_catalog(path):
+    """
+    Loads the catalog json or creates an empty one if the file does not exist.
+
+    Args:
+        path (str): Path to the catalog json.
+
+    Returns:
+        dict: The catalog.
+    """
+    catalog = {'scenes': {}, 'removed': {}, 'models': {}, 'processed': {}}
+    if os.path.exists(path):
+        with open(path) as json_file:
+            catalog.update(json.load(json_file))
+    return catalog
+
+
+def save_catalog(catalog, path):
+    """
+    Saves the catalog json. The file is first written aside and then renamed so an
+    interrupted run never leaves a broken catalog.
+
+    Args:
+        catalog (dict): The catalog.
+        path (str): Path to the catalog json.
+
+    Returns:
+        None
+    """
+    with open(path + '.tmp', 'w') as outfile:
+        json.dump(catalog, outfile, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def scan_scenes(catalog, paths, checksum = False):
+    """
+    Compares the scenes on disk with the catalog. The checksum is only computed for new
+    scenes or when the size or mtime changed, unless checksum is True. A scene whose
+    checksum did not change is kept as unchanged. The new and changed scenes are kept
+    as pending in the catalog until accept_scenes is called, so a chain that fails
+    before the end tiles them again in the next run.
+
+    Args:
+        catalog (dict): The catalog, updated in place.
+        paths (list): Paths of the scenes of the delivery.
+        checksum (bool): Recompute the checksum of every scene.
+
+    Returns:
+        new, changed, removed (list): Paths of the scenes in each case.
+    """
+    new = []
+    changed = []
+    pending = {'scenes': {}, 'removed': []}
+    scenes = catalog['scenes']
+    for path in sorted(paths):
+        stat = os.stat(path)
+        entry = scenes.get(path)
+        if entry is not None and not checksum and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            continue
+        digest = file_checksum(path)
+        if entry is not None and entry['checksum'] == digest:
+            entry['mtime'] = stat.st_mtime
+            continue
+        footprint, acquired = scene_footprint(path)
+        pending['scenes'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'checksum': digest,
+                                   'footprint': footprint, 'acquired': acquired}
+        if entry is None:
+            new.append(path)
+        else:
+            changed.append(path)
+
+    removed = sorted(set(scenes) - set(paths))
+    pending['removed'] = removed
+    catalog['pending'] = pending
+    return new, changed, removed
+
+
+def accept_scenes(catalog):
+    """
+    Moves the pending scenes of the last scan to the catalog, to be called once the
+    tiles of the scenes were created and preprocessed.
+
+    Args:
+        catalog (dict): The catalog, updated in place.
+
+    Returns:
+        int: Number of scenes updated or removed.
+    """
+    pending = catalog.pop('pending', None)
+    if pending is None:
+        print('No pending scan in the catalog')
+        return 0
+    for path, entry in pending['scenes'].items():
+        catalog['scenes'][path] = entry
+        catalog['removed'].pop(path, None)
+    for path in pending['removed']:
+        if path in catalog['scenes']:
+            catalog['removed'][path] = catalog['scenes'].pop(path)
+    return len(pending['scenes']) + len(pending['removed'])
+
+
+def clean_tiles(catalog, folders):
+    """
+    Removes the tiles of the pending changed and removed scenes, and of new scenes
+    left by a failed run, from the folders of the chain. The tiles of a scene keep
+    their names when it is tiled again, so the old ones have to go first.
+
+    Args:
+        catalog (dict): The catalog, with the pending scan.
+        folders (list): Folders with tiles, e.g. Tiled, img_with_ann and img_without_ann.
+
+    Returns:
+        int: Number of files removed.
+    """
+    pending = catalog.get('pending', {'scenes': {}, 'removed': []})
+    names = set(os.path.splitext(os.path.basename(path))[0]
+                for path in list(pending['scenes']) + pending['removed'])
+    removed = 0
+    for folder in folders:
+        for name in names:
+            for path in glob.glob(os.path.join(folder, glob.escape(name) + '_*_*.*')):
+                if not re.match(r'\d+_\d+\.', os.path.basename(path)[len(name) + 1:]):
+                    continue
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def register_model(catalog, config):
+    """
+    Hashes the weights that go with a config (model_final.pth next to config.yaml)
+    and stores them in the catalog.
+
+    Args:
+        catalog (dict): The catalog, updated in place.
+        config (str): Path to the config.yaml of the model.
+
+    Returns:
+        str: sha256 of the weights.
+    """
+    weights = "{}model_final.pth".format(config.split('config.yaml')[0])
+    digest = file_checksum(weights)
+    catalog['models'][config] = {'weights': weights, 'sha256': digest}
+    return digest
+
+
+def scene_name(tile):
+    """
+    Name of the scene a tile was cut from, following the maketiles.sh naming.
+
+    Args:
+        tile (str): Path or name of the tile.
+
+    Returns:
+        str: Name of the scene without extension.
+    """
+    return os.path.basename(tile).rsplit('_', 2)[0]
+
+
+def scene_index(scenes):
+    """
+    Index the scenes of the catalog by their name without extension.
+
+    Args:
+        scenes (dict): Scenes of the catalog.
+
+    Returns:
+        dict: {scene name: scene entry}
+    """
+    return {os.path.basename(path).split('.tif')[0]: entry for path, entry in scenes.items()}
+
+
+def tile_extents(paths):
+    """
+    Extents of tiles in their own projection, grown by half a pixel so the polygons
+    of the detections, which follow the pixel edges, fall inside them.
+
+    Args:
+        paths (list): Paths to the tiles.
+
+    Returns:
+        numpy array: (tiles, 4) array of xmin, xmax, ymin, ymax.
+    """
+    extents = np.empty((len(paths), 4), dtype=np.float64)
+    for i, path in enumerate(paths):
+        geoTrans, proj, img = raster.readraster(path, cache = False)
+        xLeft, xRight, yTop, yBottom = raster.GetPointsRaster(img)
+        img = None
+        dx = abs(geoTrans[1]) / 2.0
+        dy = abs(geoTrans[5]) / 2.0
+        extents[i] = (min(xLeft, xRight) - dx, max(xLeft, xRight) + dx,
+                      min(yTop, yBottom) - dy, max(yTop, yBottom) + dy)
+    return extents
+
+
+def purge_detections(shpname, weightname, tiles = None, paths = None):
+    """
+    Deletes the detections of a model, all of them or only the ones of some tiles
+    (the tile field written by shapefile.ArrayToPoly). Used to remove the results of
+    tiles that are processed again or whose scene was removed, before the new ones
+    are appended. Detections written before the tile field existed have no tile, they
+    are matched by falling inside the extent of one of paths.
+
+    Args:
+        shpname (str): Path to the shapefile with the detections (FinalGeoms.shp).
+        weightname (str): Path to the config of the model, as saved in weightname.
+        tiles (set): Names of the tiles whose detections are deleted. If None all
+            the detections of the model are deleted.
+        paths (list): Optional paths to the tiles to match the detections without tile.
+
+    Returns:
+        int: Number of detections deleted.
+    """
+    if not os.path.exists(shpname):
+        return 0
+    layer, driver, dataSource = shapefile.openshp(shpname, 1)
+    layerDefn = layer.GetLayerDefn()
+    has_tile = layerDefn.GetFieldIndex('tile') >= 0
+    if tiles is not None and not has_tile and not paths:
+        print("{} has no tile field, the detections can not be matched to their tiles".format(shpname))
+        return 0
+
+    # shapefiles created before the fields had an explicit width keep the values truncated
+    width = layerDefn.GetFieldDefn(layerDefn.GetFieldIndex('weightname')).GetWidth()
+    weightname = weightname[:width] if width > 0 else weightname
+
+    extents = None
+    fids = []
+    for feature in layer:
+        if feature.GetField('weightname') != weightname:
+            continue
+        tile = feature.GetField('tile') if has_tile else None
+        if tiles is None or tile in tiles:
+            fids.append(feature.GetFID())
+        elif tile is None and paths:
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+            if extents is None:
+                extents = tile_extents(paths)
+            xmin, xmax, ymin, ymax = geom.GetEnvelope()
+            if np.any((extents[:, 0] <= xmin) & (extents[:, 1] >= xmax) &
+                      (extents[:, 2] <= ymin) & (extents[:, 3] >= ymax)):
+                fids.append(feature.GetFID())
+    layer.ResetReading()
+
+    for fid in fids:
+        layer.DeleteFeature(fid)
+    if fids:
+        dataSource.ExecuteSQL('REPACK {}'.format(layer.GetName()))
+    dataSource = None
+    return len(fids)
+
+
+def tile_records(catalog, config, output, digest):
+    """
+    Records of the tiles processed with a model into an output shapefile. Each output
+    keeps its own records, the same model can write to several of them.
+
+    Args:
+        catalog (dict): The catalog, updated in place.
+        config (str): Path to the config.yaml of the model.
+        output (str): Path to the shapefile with the detections.
+        digest (str): sha256 of the weights, see register_model.
+
+    Returns:
+        dict: {sha256, tiles: {tile name: scene checksum}}. Its sha256 is the one of
+        the weights the tiles were processed with, it can differ from digest.
+    """
+    outputs = catalog['processed'].setdefault(config, {})
+    if 'sha256' in outputs:
+        print("Records of {} were not kept per output, all its tiles will be processed".format(config))
+        outputs.clear()
+    return outputs.setdefault(output, {'sha256': digest, 'tiles': {}})
+
+
+def plan_tiles(catalog, config, output, tiles):
+    """
+    Selects the tiles that need (re)processing with a model into an output. A tile is
+    selected if the model weights changed, if it was never processed with this model
+    into this output, or if its scene changed since it was processed. Tiles whose scene
+    was removed or is not in the catalog are never selected. The detections of the
+    model on the selected tiles and on the tiles whose scene was removed are deleted
+    from the output, so the following inference appends the new ones. The selected
+    tiles are purged even if they have no record, a run interrupted before
+    commit_tiles left their detections.
+
+    Args:
+        catalog (dict): The catalog, updated in place.
+        config (str): Path to the config.yaml of the model (the weightname of the detections).
+        output (str): Path to the shapefile with the detections of this model (FinalGeoms.shp).
+        tiles (list): Paths of the candidate tiles.
+
+    Returns:
+        list: Paths of the tiles to process.
+    """
+    digest = register_model(catalog, config)
+    scenes = scene_index(catalog['scenes'])
+    processed = tile_records(catalog, config, output, digest)
+
+    if processed['sha256'] != digest:
+        print("Weights of {} changed, all the tiles will be processed".format(config))
+        deleted = purge_detections(output, config)
+        print("{} detections removed from {}".format(deleted, output))
+        processed['sha256'] = digest
+        processed['tiles'] = {}
+    records = processed['tiles']
+
+    # tiles processed with another version of their scene, or whose scene is gone
+    stale = set()
+    for name, version in records.items():
+        scene = scenes.get(scene_name(name))
+        if scene is None or scene['checksum'] != version:
+            stale.add(name)
+    for name in stale:
+        del records[name]
+
+    todo = []
+    unknown = 0
+    for tile in tiles:
+        scene = scenes.get(scene_name(tile))
+        if scene is None:
+            unknown += 1
+        elif records.get(os.path.basename(tile)) != scene['checksum']:
+            todo.append(tile)
+    if unknown:
+        print("{} tiles skipped, their scene was removed or is not in the catalog".format(unknown))
+
+    names = stale | {os.path.basename(tile) for tile in todo}
+    if names:
+        deleted = purge_detections(output, config, names, todo)
+        print("{} detections of {} tiles removed from {}".format(deleted, len(names), output))
+
+    print("{} of {} tiles to process with {} into {}".format(len(todo), len(tiles), config, output))
+    return todo
+
+
+def commit_tiles(catalog, config, output, tiles):
+    """
+    Records that the tiles were processed into an output with the current weights of
+    the model. Tiles whose scene is not in the catalog are not recorded.
+
+    Args:
+        catalog (dict): The catalog, updated in place.
+        config (str): Path to the config.yaml of the model.
+        output (str): Path to the shapefile with the detections of this model.
+        tiles (list): Paths of the processed tiles.
+
+    Returns:
+        None
+    """
+    digest = register_model(catalog, config)
+    scenes = scene_index(catalog['scenes'])
+    processed = tile_records(catalog, config, output, digest)
+    if processed['sha256'] != digest:
+        processed['sha256'] = digest
+        processed['tiles'] = {}
+    for tile in tiles:
+        scene = scenes.get(scene_name(tile))
+        if scene is not None:
+            processed['tiles'][os.path.basename(tile)] = scene['checksum']
+
+
+def read_list(path):
+    """
+    Reads a list of paths, one per line, as the csv lists of the chain.
+    """
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_list(path, lines):
+    """
+    Writes a list of paths, one per line.
+    """
+    with open(path, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental reprocessing of new scenes and models.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    scan = subparsers.add_parser('scan', help='Update the scene catalog and list the scenes to tile.')
+    scan.add_argument('catalog', type=str, help='Path to the catalog json.')
+    scan.add_argument('images', type=str, help='Glob of the scenes, e.g. "$DIR/images/*/*tif".')
+    scan.add_argument('delta', type=str, help='Where to write the list of new and changed scenes.')
+    scan.add_argument('--checksum', action='store_true', help='Recompute the checksum of every scene.')
+
+    plan = subparsers.add_parser('plan', help='List the tiles to process with a model.')
+    plan.add_argument('catalog', type=str, help='Path to the catalog json.')
+    plan.add_argument('config', type=str, help='Path to the config.yaml of the model.')
+    plan.add_argument('output', type=str, help='Shapefile with the detections of the model to update.')
+    plan.add_argument('tiles', type=str, help='List of candidate tiles.')
+    plan.add_argument('delta', type=str, help='Where to write the list of tiles to process.')
+
+    clean = subparsers.add_parser('clean', help='Remove the old tiles of the pending scenes.')
+    clean.add_argument('catalog', type=str, help='Path to the catalog json.')
+    clean.add_argument('folders', type=str, nargs='+', help='Folders with tiles.')
+
+    accept = subparsers.add_parser('accept', help='Record the pending scenes once they are tiled.')
+    accept.add_argument('catalog', type=str, help='Path to the catalog json.')
+
+    commit = subparsers.add_parser('commit', help='Record the tiles processed with a model.')
+    commit.add_argument('catalog', type=str, help='Path to the catalog json.')
+    commit.add_argument('config', type=str, help='Path to the config.yaml of the model.')
+    commit.add_argument('output', type=str, help='Shapefile with the detections of the model.')
+    commit.add_argument('tiles', type=str, help='List of processed tiles.')
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    start = time.time()
+    catalog = load_catalog(args.catalog)
+    if args.command == 'scan':
+        new, changed, removed = scan_scenes(catalog, glob.glob(args.images), args.checksum)
+        write_list(args.delta, new + changed)
+        print("{} new, {} changed and {} removed scenes".format(len(new), len(changed), len(removed)))
+    elif args.command == 'clean':
+        print("{} files removed".format(clean_tiles(catalog, args.folders)))
+    elif args.command == 'accept':
+        print("{} scenes accepted".format(accept_scenes(catalog)))
+    elif args.command == 'plan':
+        write_list(args.delta, plan_tiles(catalog, args.config, args.output, read_list(args.tiles)))
+    else:
+        commit_tiles(catalog, args.config, args.output, read_list(args.tiles))
+    save_catalog(catalog, args.catalog)
+
+    end = time.time()
+    print("Finish!!! :). Execution time: {}".format(end - start))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+__author__ = "Laura Martinez Sanchez"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "lmartisa@gmail.com"
+
+import sys
+import os
+syspath = "{}/code/scripts/GDAL-python".format(os.environ['DIR'])
+sys.path.append(syspath)
+import shapefile
+import rasteraccess
+from osgeo import ogr
+import multiprocessing as mp
+import numpy as np
+import argparse
+import traceback
+import shutil
+import multiprocessing.connection
+import collections
+import json
+import time
+
+# Inference of a list of tiles with several processes. The tiles are split in small
+# chunks, every worker loads the model once and is sent the next chunk when it reports
+# the previous one, so slow tiles do not stall the others. Each worker has its own task
+# queue and status pipe, so the chunk each worker holds is always known and a worker
+# killed while writing can not block the messages of the others.
+# Each chunk is written to its own shard (shards/worker_XX/chunk_XXXXX/FinalGeoms.shp)
+# and the finished shards are appended to the FinalGeoms of the output folder at the end.
+# If a worker dies, the chunk it held is given to another worker and a new worker
+# is started.
+
+
+def load_conf_file(path, device = 'cpu'):
+    """
+    Loads the detectron2 config of a model with its weights, as in the inference notebook.
+
+    Args:
+        path (str): Path to the config.yaml of the model.
+        device (str): Device where the model runs.
+
+    Returns:
+        CfgNode: The config.
+    """
+    from detectron2.config import get_cfg
+
+    weights_path = "{}model_final.pth".format(path.split('config.yaml')[0])
+    cfg = get_cfg()
+    cfg.set_new_allowed(True)
+
+    cfg.merge_from_file(path)
+    cfg.DATASETS.TRAIN = ("swalim_train", )
+    cfg.DATASETS.TEST = ("swalim_test", )
+    cfg.DATALOADER.NUM_WORKERS = 4
+    cfg.MODEL.WEIGHTS = weights_path
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.5
+    cfg.MODEL.DEVICE = device
+    return cfg
+
+
+def detect_tiles(predictor, tiles, outdir, config, submit_dir):
+    """
+    Runs the detector on a list of tiles and polygonizes the boxes in outdir/FinalGeoms.shp.
+
+    Args:
+        predictor (DefaultPredictor): The loaded model.
+        tiles (list): Paths to the tiles.
+        outdir (str): Folder of the shard.
+        config (str): Path to the config of the model, saved as weightname.
+        submit_dir (str): Final output folder, saved as submitname.
+
+    Returns:
+        None
+    """
+    # read with the shared cache, so ArrayToPoly finds the dataset of the tile open
+    for d, im in rasteraccess.read_ahead(tiles, rasteraccess.read_bgr, workers = 2, depth = 4):
+        outputs = predictor(im)
+        out = outputs["instances"].to("cpu")
+        scores = out.scores
+        boxes = out.pred_boxes.tensor.detach().numpy()
+        if len(boxes) > 0:
+            control = np.zeros((im.shape[0], im.shape[1]), dtype=int)
+            for i in range(len(boxes)):
+                control[int(boxes[i][1]): int(boxes[i][3]), int(boxes[i][0]): int(boxes[i][2])] = 1
+
+            name = '{}{}'.format(outdir, d.split('.tif')[0].split('/')[-1])
+            shapefile.ArrayToPoly(d, control, name, submit_dir, config, scores)
+
+
+def chunk_dir(shard_dir, wid, cid):
+    return os.path.join(shard_dir, 'worker_{:02d}'.format(wid), 'chunk_{:05d}'.format(cid), '')
+
+
+def _worker(wid, config, threads, device, task_q, status, shard_dir, submit_dir):
+    """
+    Worker process. Loads the model once and runs the chunks of its queue until it
+    gets None. Sends ('ready', wid, seconds), ('done', wid, cid, tiles, seconds) and
+    ('error', wid, cid, traceback) through the status pipe.
+    """
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    import torch
+    from detectron2.engine import DefaultPredictor
+
+    torch.set_num_threads(threads)
+    start = time.time()
+    predictor = DefaultPredictor(load_conf_file(config, device))
+    status.send(('ready', wid, time.time() - start))
+
+    while True:
+        task = task_q.get()
+        if task is None:
+            break
+        cid, tiles = task
+        outdir = chunk_dir(shard_dir, wid, cid)
+        shutil.rmtree(outdir, ignore_errors=True)
+        os.makedirs(outdir)
+        start = time.time()
+        try:
+            detect_tiles(predictor, tiles, outdir, config, submit_dir)
+        except Exception:
+            status.send(('error', wid, cid, traceback.format_exc()))
+            continue
+        status.send(('done', wid, cid, len(tiles), time.time() - start))
+
+
+def merge_shards(shards, outdir):
+    """
+    Appends the detections of the shards to outdir/FinalGeoms.shp, creating it if needed
+    with the same fields as shapefile.ArrayToPoly (see shapefile.CreateResultFields).
+
+    Args:
+        shards (list): Paths to the FinalGeoms.shp of the finished chunks.
+        outdir (str): Output folder.
+
+    Returns:
+        int: Number of detections appended.
+    """
+    outname = os.path.join(outdir, 'FinalGeoms.shp')
+    drv = ogr.GetDriverByName("ESRI Shapefile")
+    dst_ds = None
+    count = 0
+    for shard in shards:
+        if not os.path.exists(shard):
+            continue
+        layer, driver, dataSource = shapefile.openshp(shard, 0)
+        if dst_ds is None:
+            if os.path.exists(outname):
+                dst_ds = drv.Open(outname, 1)
+                dst_layer = dst_ds.GetLayer()
+            else:
+                dst_ds = drv.CreateDataSource(outname)
+                dst_layer = dst_ds.CreateLayer('results', srs = layer.GetSpatialRef(), geom_type = ogr.wkbMultiPolygon)
+            shapefile.CreateResultFields(dst_layer)
+            featureDefn = dst_layer.GetLayerDefn()
+        for feature in layer:
+            outFeature = ogr.Feature(featureDefn)
+            outFeature.SetField('submitname', feature.GetField('submitname'))
+            outFeature.SetField('weightname', feature.GetField('weightname'))
+            outFeature.SetField('proba', feature.GetField('proba'))
+            outFeature.SetField('tile', feature.GetField('tile'))
+            outFeature.SetGeometry(feature.GetGeometryRef())
+            dst_layer.CreateFeature(outFeature)
+            outFeature = None
+            count += 1
+        dataSource = None
+    if dst_ds is not None:
+        dst_layer.SyncToDisk()
+        dst_layer = None
+        dst_ds = None
+    return count
+
+
+def run(config, path_list_imgs, path_copy_im, workers, threads = None, chunk_size = 8, max_retries = 2, device = 'cpu'):
+    """
+    Runs the inference of a list of tiles sharded across several worker processes.
+
+    Args:
+        config (str): Path to the config.yaml of the model.
+        path_list_imgs (str): List of tiles, one per line.
+        path_copy_im (str): Output folder, the detections are appended to its FinalGeoms.shp.
+        workers (int): Number of worker processes.
+        threads (int): torch threads of each worker, by default the cores divided by workers.
+        chunk_size (int): Number of tiles taken from the queue at a time.
+        max_retries (int): Times a chunk is requeued after its worker failed before giving up.
+        device (str): Device where the models run.
+
+    Returns:
+        dict: Report with the throughput of each worker and the failed tiles.
+    """
+    with open(path_list_imgs) as f:
+        tiles = [line.strip() for line in f if line.strip()]
+    chunks = [tiles[i:i + chunk_size] for i in range(0, len(tiles), chunk_size)]
+    if threads is None:
+        threads = max(1, mp.cpu_count() // workers)
+    shard_dir = os.path.join(path_copy_im, 'shards')
+    shutil.rmtree(shard_dir, ignore_errors=True)
+
+    ctx = mp.get_context('spawn')
+    pending = collections.deque(range(len(chunks)))
+
+    procs = {}
+    queues = {}
+    pipes = {}
+    stats = {}
+
+    def spawn():
+        wid = len(stats)
+        task_q = ctx.Queue()
+        reader, writer = ctx.Pipe(duplex=False)
+        p = ctx.Process(target=_worker, args=(wid, config, threads, device, task_q, writer, shard_dir, path_copy_im))
+        p.start()
+        # only the worker keeps the writing end, so the pipe ends when it dies
+        writer.close()
+        procs[wid] = p
+        queues[wid] = task_q
+        pipes[wid] = reader
+        stats[wid] = {'pid': p.pid, 'tiles': 0, 'chunks': 0, 'busy': 0.0, 'load': None, 'status': 'running'}
+
+    start = time.time()
+    for i in range(min(workers, len(chunks))):
+        spawn()
+
+    # chunk held by each worker, from the moment it is put in its queue until it reports it
+    assigned = {}
+    attempts = {}
+    done = {}
+    failed = set()
+
+    def retry(cid):
+        attempts[cid] = attempts.get(cid, 0) + 1
+        if attempts[cid] > max_retries:
+            print("Chunk {} failed {} times, giving up".format(cid, attempts[cid]))
+            failed.add(cid)
+        else:
+            pending.append(cid)
+
+    def feed():
+        for wid in procs:
+            if pending and wid not in assigned and stats[wid]['load'] is not None:
+                cid = pending.popleft()
+                assigned[wid] = cid
+                queues[wid].put((cid, chunks[cid]))
+
+    def handle(msg):
+        kind, wid = msg[0], msg[1]
+        if kind == 'ready':
+            stats[wid]['load'] = msg[2]
+        elif kind == 'done':
+            cid = msg[2]
+            assigned.pop(wid, None)
+            if cid in done or cid in failed:
+                # a requeued chunk finished twice, keep only the first shard
+                shutil.rmtree(chunk_dir(shard_dir, wid, cid), ignore_errors=True)
+                return
+            done[cid] = chunk_dir(shard_dir, wid, cid)
+            stats[wid]['tiles'] += msg[3]
+            stats[wid]['chunks'] += 1
+            stats[wid]['busy'] += msg[4]
+        elif kind == 'error':
+            cid = msg[2]
+            assigned.pop(wid, None)
+            print("Worker {} failed on chunk {}:\n{}".format(wid, cid, msg[3]))
+            shutil.rmtree(chunk_dir(shard_dir, wid, cid), ignore_errors=True)
+            if cid not in done:
+                retry(cid)
+
+    def receive(wid):
+        # reads the messages waiting in the pipe of a worker, False once it is closed
+        reader = pipes[wid]
+        while reader.poll():
+            try:
+                handle(reader.recv())
+            except (EOFError, OSError):
+                return False
+        return True
+
+    while len(done) + len(failed) < len(chunks):
+        for reader in mp.connection.wait(list(pipes.values()), timeout=1):
+            wid = [w for w, r in pipes.items() if r is reader][0]
+            if not receive(wid):
+                pipes.pop(wid).close()
+
+        # checked on every iteration, busy workers would otherwise hide a dead one
+        for wid, p in list(procs.items()):
+            if p.is_alive():
+                continue
+            # read the messages it sent before dying
+            if wid in pipes:
+                receive(wid)
+                pipes.pop(wid).close()
+            del procs[wid]
+            stats[wid]['status'] = 'crashed (exit code {})'.format(p.exitcode)
+            if stats[wid]['load'] is None:
+                # the model can not be loaded, new workers would die the same way
+                for other in procs.values():
+                    other.terminate()
+                raise RuntimeError("Worker {} died loading {} with exit code {}".format(wid, config, p.exitcode))
+            cid = assigned.pop(wid, None)
+            print("Worker {} died with exit code {}, chunk {} requeued".format(wid, p.exitcode, cid))
+            if cid is not None and cid not in done:
+                shutil.rmtree(chunk_dir(shard_dir, wid, cid), ignore_errors=True)
+                retry(cid)
+            if len(done) + len(failed) < len(chunks):
+                spawn()
+        feed()
+
+    for wid in procs:
+        queues[wid].put(None)
+    for wid, p in procs.items():
+        p.join()
+        stats[wid]['status'] = 'finished'
+    for reader in pipes.values():
+        reader.close()
+
+    merged = merge_shards([os.path.join(done[cid], 'FinalGeoms.shp') for cid in sorted(done)], path_copy_im)
+    shutil.rmtree(shard_dir, ignore_errors=True)
+
+    elapsed = time.time() - start
+    for wid in stats:
+        stats[wid]['tiles_per_s'] = stats[wid]['tiles'] / stats[wid]['busy'] if stats[wid]['busy'] > 0 else 0.0
+    report = {'tiles': len(tiles), 'chunks': len(chunks), 'workers': workers, 'threads': threads,
+              'seconds': elapsed, 'tiles_per_s': len(tiles) / elapsed if elapsed > 0 else 0.0,
+              'detections': merged, 'per_worker': stats,
+              'failed_tiles': [tile for cid in sorted(failed) for tile in chunks[cid]]}
+
+    for wid, s in sorted(stats.items()):
+        print("worker {:02d} pid {}: {} tiles in {} chunks, {:.2f} tiles/s, model loaded in {}s, {}".format(
+              wid, s['pid'], s['tiles'], s['chunks'], s['tiles_per_s'],
+              '{:.1f}'.format(s['load']) if s['load'] is not None else '-', s['status']))
+    print("{} tiles in {:.1f}s ({:.2f} tiles/s), {} detections, {} tiles failed".format(
+          len(tiles), elapsed, report['tiles_per_s'], merged, len(report['failed_tiles'])))
+
+    with open(os.path.join(path_copy_im, 'scheduler_report.json'), 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded multi-process inference of a list of tiles.')
+    parser.add_argument('config', type=str, help='Path to the config.yaml of the model.')
+    parser.add_argument('tiles', type=str, help='List of tiles to process.')
+    parser.add_argument('output', type=str, help='Output folder, the detections are appended to its FinalGeoms.shp.')
+    parser.add_argument('-w', dest='workers', type=int, default=max(1, mp.cpu_count() // 4), help='Number of worker processes.')
+    parser.add_argument('-t', dest='threads', type=int, default=None, help='torch threads per worker (default cores/workers).')
+    parser.add_argument('-c', dest='chunk_size', type=int, default=8, help='Tiles taken from the queue at a time (default 8).')
+    parser.add_argument('-r', dest='max_retries', type=int, default=2, help='Requeues of a chunk after a worker failure (default 2).')
+    parser.add_argument('--device', type=str, default='cpu', help='Device where the models run (default cpu).')
+    args = parser.parse_args()
+
+    output = os.path.join(args.output, '')
+    os.makedirs(output, exist_ok=True)
+    report = run(args.config, args.tiles, output, args.workers, args.threads, args.chunk_size, args.max_retries, args.device)
+    print("Finish!!! :). Execution time: {}".format(report['seconds']))
+    sys.exit(1 if report['failed_tiles'] else 0)
+
+
+if __name__ == '__main__':
+    main()
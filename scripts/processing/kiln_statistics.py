@@ -0,0 +1,403 @@
+__author__ = "Laura Martinez Sanchez"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "lmartisa@gmail.com"
+
+import sys
+import os
+syspath = "{}/code/scripts/GDAL-python".format(os.environ['DIR'])
+sys.path.append(syspath)
+import raster
+from osgeo import osr, ogr
+import numpy as np
+import argparse
+import json
+import time
+
+
+def traditional_order(srs):
+    """
+    Force x/y (lon/lat) axis order on a spatial reference. GDAL >= 3 follows the
+    authority axis order by default, which swaps coordinates for EPSG:4326.
+
+    Args:
+        srs (osr.SpatialReference): The spatial reference to modify.
+
+    Returns:
+        osr.SpatialReference: The same spatial reference.
+    """
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def equal_area_srs(layers, user_srs = None):
+    """
+    Build the equal-area projection used to measure the detections. If no projection
+    is given, a Lambert azimuthal equal-area projection centred on the extent of the
+    layers is used, which keeps the distortion of perimeters low over a country-sized area.
+
+    Args:
+        layers (list): Layers with the detections, in the same projection.
+        user_srs (str): Optional projection in any format accepted by SetFromUserInput
+            (e.g. "EPSG:6933" or a proj string).
+
+    Returns:
+        osr.SpatialReference: The equal-area spatial reference.
+    """
+    srs = osr.SpatialReference()
+    if user_srs is not None:
+        srs.SetFromUserInput(user_srs)
+        return traditional_order(srs)
+
+    extents = np.array([layer.GetExtent() for layer in layers])
+    xmin, ymin = extents[:, 0].min(), extents[:, 2].min()
+    xmax, ymax = extents[:, 1].max(), extents[:, 3].max()
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    transform = osr.CoordinateTransformation(traditional_order(layers[0].GetSpatialRef().Clone()),
+                                             traditional_order(wgs84))
+    lon, lat = transform.TransformPoint((xmin + xmax) / 2.0, (ymin + ymax) / 2.0)[:2]
+    srs.ImportFromProj4('+proj=laea +lat_0={} +lon_0={} +x_0=0 +y_0=0 +datum=WGS84 +units=m +no_defs'.format(lat, lon))
+    return traditional_order(srs)
+
+
+def read_rings(layer, score_field = 'proba'):
+    """
+    Read the coordinates of the rings of every detection once, in the projection of
+    the layer. Multipolygons are read part by part, the first ring of each part is
+    its exterior and the next ones its holes.
+
+    Args:
+        layer (ogr.Layer): Layer with the detections (e.g. the FinalGeoms shapefile).
+        score_field (str): Name of the field with the detection score.
+
+    Returns:
+        dict: 'xy' (points, 2) coordinates of all the rings one after the other,
+        'size' (rings,) number of points of each ring, 'feature' (rings,) index of
+        the detection of each ring, 'hole' (rings,) True for the interior rings and
+        'score' (detections,). Features without geometry are skipped.
+    """
+    has_score = layer.GetLayerDefn().GetFieldIndex(score_field) >= 0
+    xy = []
+    size = []
+    feature_index = []
+    hole = []
+    score = []
+
+    layer.ResetReading()
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        if ogr.GT_Flatten(geom.GetGeometryType()) == ogr.wkbPolygon:
+            parts = [geom]
+        else:
+            parts = [geom.GetGeometryRef(i) for i in range(geom.GetGeometryCount())]
+        rings = 0
+        for part in parts:
+            for k in range(part.GetGeometryCount()):
+                points = part.GetGeometryRef(k).GetPoints()
+                if not points:
+                    continue
+                xy.append(np.asarray(points, dtype=np.float64)[:, :2])
+                size.append(len(points))
+                feature_index.append(len(score))
+                hole.append(k > 0)
+                rings += 1
+        if rings == 0:
+            continue
+        score.append(feature.GetField(score_field) if has_score else np.nan)
+    layer.ResetReading()
+
+    return {'xy': np.concatenate(xy) if xy else np.empty((0, 2), dtype=np.float64),
+            'size': np.asarray(size, dtype=np.int64),
+            'feature': np.asarray(feature_index, dtype=np.int64),
+            'hole': np.asarray(hole, dtype=bool),
+            'score': np.asarray(score, dtype=np.float64)}
+
+
+def ring_measures(rings):
+    """
+    Area, perimeter, centroid and bounding box of every detection from the coordinates
+    of its rings, with the shoelace formula over all the rings at once. Holes are
+    subtracted from the area and the centroid, and added to the perimeter as in
+    ST_Perimeter.
+
+    Args:
+        rings (dict): Output of read_rings, with the coordinates already projected.
+
+    Returns:
+        dict: arrays 'area', 'perimeter', 'x', 'y' (centroid) and 'bbox' (detections, 4)
+        with xmin, xmax, ymin, ymax.
+    """
+    n = rings['score'].size
+    x = rings['xy'][:, 0]
+    y = rings['xy'][:, 1]
+    size = rings['size']
+    ring = np.repeat(np.arange(size.size), size)
+
+    # next point of each point, the last one of a ring goes back to the first
+    first = np.cumsum(size) - size
+    nxt = np.arange(x.size) + 1
+    nxt[first + size - 1] = first
+    cross = x * y[nxt] - x[nxt] * y
+
+    signed = np.bincount(ring, weights=cross, minlength=size.size) / 2.0
+    length = np.bincount(ring, weights=np.hypot(x[nxt] - x, y[nxt] - y), minlength=size.size)
+    cx = np.bincount(ring, weights=(x + x[nxt]) * cross, minlength=size.size)
+    cy = np.bincount(ring, weights=(y + y[nxt]) * cross, minlength=size.size)
+
+    # area of each ring with the sign of its role, the orientation of the rings is not trusted
+    ring_area = np.where(rings['hole'], -1.0, 1.0) * np.abs(signed)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ring_x = np.where(signed != 0, cx / (6.0 * signed), 0.0)
+        ring_y = np.where(signed != 0, cy / (6.0 * signed), 0.0)
+
+    feature = rings['feature']
+    area = np.bincount(feature, weights=ring_area, minlength=n)
+    perimeter = np.bincount(feature, weights=length, minlength=n)
+
+    bbox = np.empty((n, 4), dtype=np.float64)
+    point_feature = feature[ring]
+    for j, (values, reduce) in enumerate([(x, np.minimum), (x, np.maximum), (y, np.minimum), (y, np.maximum)]):
+        bbox[:, j] = np.inf if reduce is np.minimum else -np.inf
+        reduce.at(bbox[:, j], point_feature, values)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroid_x = np.bincount(feature, weights=ring_area * ring_x, minlength=n) / area
+        centroid_y = np.bincount(feature, weights=ring_area * ring_y, minlength=n) / area
+    # degenerate detections without area take the centre of their bounding box
+    flat = ~(area > 0)
+    centroid_x[flat] = (bbox[flat, 0] + bbox[flat, 1]) / 2.0
+    centroid_y[flat] = (bbox[flat, 2] + bbox[flat, 3]) / 2.0
+
+    return {'area': area, 'perimeter': perimeter, 'x': centroid_x, 'y': centroid_y, 'bbox': bbox}
+
+
+def detection_geometry(rings, index):
+    """
+    Build the OGR geometry of one detection from the coordinates of its rings.
+
+    Args:
+        rings (dict): Output of read_rings.
+        index (int): Index of the detection.
+
+    Returns:
+        ogr.Geometry: Polygon, or multipolygon if the detection has several parts.
+    """
+    first = np.cumsum(rings['size']) - rings['size']
+    polygons = []
+    for r in np.flatnonzero(rings['feature'] == index):
+        if not rings['hole'][r]:
+            polygons.append(ogr.Geometry(ogr.wkbPolygon))
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for px, py in rings['xy'][first[r]:first[r] + rings['size'][r]]:
+            ring.AddPoint_2D(float(px), float(py))
+        polygons[-1].AddGeometry(ring)
+    if len(polygons) == 1:
+        return polygons[0]
+    geom = ogr.Geometry(ogr.wkbMultiPolygon)
+    for polygon in polygons:
+        geom.AddGeometry(polygon)
+    return geom
+
+
+def find_duplicates(rings, measures, overlap = 0.5):
+    """
+    Flag the detections of a kiln found more than once, as the tiles overlap a kiln on
+    a tile edge is detected in both tiles. As in the postgres product, a detection is
+    a duplicate if it intersects an earlier one on more than overlap of the area of
+    the earlier one. Only the pairs whose bounding boxes overlap are intersected.
+
+    Args:
+        rings (dict): Output of read_rings, projected.
+        measures (dict): Output of ring_measures.
+        overlap (float): Fraction of the area of the earlier detection.
+
+    Returns:
+        numpy array: Boolean mask of the duplicated detections.
+    """
+    xmin, xmax, ymin, ymax = measures['bbox'].T
+    n = xmin.size
+    order = np.argsort(xmin, kind='stable')
+    sorted_xmin = xmin[order]
+    duplicate = np.zeros(n, dtype=bool)
+    geoms = {}
+
+    def geometry(i):
+        if i not in geoms:
+            geoms[i] = detection_geometry(rings, i)
+        return geoms[i]
+
+    for k in range(n):
+        i = order[k]
+        others = order[k + 1:np.searchsorted(sorted_xmin, xmax[i], side='right')]
+        others = others[(ymin[others] <= ymax[i]) & (ymax[others] >= ymin[i])]
+        for j in others:
+            a, b = min(i, j), max(i, j)
+            if duplicate[b] or measures['area'][a] <= 0:
+                continue
+            intersection = geometry(a).Intersection(geometry(b))
+            if intersection is not None and intersection.Area() / measures['area'][a] > overlap:
+                duplicate[b] = True
+    return duplicate
+
+
+def geometry_arrays(layers, srs, score_field = 'proba', overlap = 0.5):
+    """
+    Read the detections of one or several layers, project them to the equal-area
+    projection, drop the duplicates and collect their measures in NumPy arrays. The
+    coordinates are read once per feature and transformed in bulk, the measures are
+    computed with NumPy.
+
+    Args:
+        layers (list): Layers with the detections (e.g. the FinalGeoms shapefiles of
+            the f1score and recall models), merged as in the postgres product.
+        srs (osr.SpatialReference): Equal-area projection where the measures are taken.
+        score_field (str): Name of the field with the detection score.
+        overlap (float): Overlap above which a detection is a duplicate, see find_duplicates.
+            None keeps all the detections.
+
+    Returns:
+        dict: arrays 'area' (m2), 'perimeter' (m), 'x' and 'y' (centroid in the
+        equal-area projection) and 'score', and 'duplicates' the number of detections
+        dropped. Features without geometry are skipped.
+    """
+    parts = []
+    offset = 0
+    for layer in layers:
+        rings = read_rings(layer, score_field)
+        if rings['xy'].shape[0] > 0:
+            transform = osr.CoordinateTransformation(traditional_order(layer.GetSpatialRef().Clone()), srs)
+            rings['xy'] = np.asarray(transform.TransformPoints(rings['xy'].tolist()), dtype=np.float64)[:, :2]
+        rings['feature'] = rings['feature'] + offset
+        offset += rings['score'].size
+        parts.append(rings)
+    rings = {key: np.concatenate([part[key] for part in parts]) for key in ['xy', 'size', 'feature', 'hole', 'score']}
+
+    measures = ring_measures(rings)
+    if overlap is not None:
+        keep = ~find_duplicates(rings, measures, overlap)
+    else:
+        keep = np.ones(rings['score'].size, dtype=bool)
+
+    return {'area': measures['area'][keep], 'perimeter': measures['perimeter'][keep],
+            'x': measures['x'][keep], 'y': measures['y'][keep], 'score': rings['score'][keep],
+            'duplicates': int((~keep).sum())}
+
+
+def kiln_statistics(arrays):
+    """
+    Compute the per-detection derived measures and the summary statistics.
+    The diameter follows the definition of the postgres product (perimeter/4) and
+    the equivalent diameter is the diameter of the circle with the same area.
+
+    Args:
+        arrays (dict): Output of geometry_arrays. 'diameter' and 'eq_diameter' are added to it.
+
+    Returns:
+        dict: For each measure the count, sum, mean, std, min, percentiles 25/50/75 and max.
+    """
+    arrays['diameter'] = arrays['perimeter'] / 4.0
+    arrays['eq_diameter'] = 2.0 * np.sqrt(arrays['area'] / np.pi)
+
+    summary = {}
+    for key in ['area', 'perimeter', 'diameter', 'eq_diameter', 'score']:
+        values = arrays[key][~np.isnan(arrays[key])]
+        if values.size == 0:
+            summary[key] = {'count': 0}
+            continue
+        p25, p50, p75 = np.percentile(values, [25, 50, 75])
+        summary[key] = {'count': int(values.size),
+                        'sum': float(values.sum()),
+                        'mean': float(values.mean()),
+                        'std': float(values.std()),
+                        'min': float(values.min()),
+                        'p25': float(p25),
+                        'median': float(p50),
+                        'p75': float(p75),
+                        'max': float(values.max())}
+    return summary
+
+
+def density_grid(arrays, cellsize):
+    """
+    Aggregate the detections on a regular grid by the cell that holds their centroid.
+
+    Args:
+        arrays (dict): Output of geometry_arrays.
+        cellsize (float): Size of the grid cells in meters.
+
+    Returns:
+        counts (numpy array): Number of kilns per cell, shape (rows, cols).
+        areas (numpy array): Total kiln area (m2) per cell, shape (rows, cols).
+        geoTrans (tuple): Geotransform of the grid.
+    """
+    x = arrays['x']
+    y = arrays['y']
+    xmin = np.floor(x.min() / cellsize) * cellsize
+    ymax = np.ceil(y.max() / cellsize) * cellsize
+
+    col = np.floor((x - xmin) / cellsize).astype(np.int64)
+    row = np.floor((ymax - y) / cellsize).astype(np.int64)
+    cols = int(col.max()) + 1
+    rows = int(row.max()) + 1
+
+    cell = row * cols + col
+    counts = np.bincount(cell, minlength=rows * cols).reshape(rows, cols)
+    areas = np.bincount(cell, weights=arrays['area'], minlength=rows * cols).reshape(rows, cols)
+
+    geoTrans = (xmin, cellsize, 0.0, ymax, 0.0, -cellsize)
+    return counts, areas, geoTrans
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Geometry statistics and gridded density of the kiln detections.')
+    parser.add_argument('detections', type=str, nargs='+',
+                        help='Paths to the detections (e.g. the FinalGeoms.shp of each model or a PG: connection), merged.')
+    parser.add_argument('output', type=str, help='Output name (without extension) of the density GeoTIFF and the statistics json.')
+    parser.add_argument('-c', dest='cellsize', type=float, default=1000.0, help='Grid cell size in meters (default 1000).')
+    parser.add_argument('-s', dest='srs', type=str, default=None,
+                        help='Equal-area projection (default: Lambert azimuthal equal-area centred on the data).')
+    parser.add_argument('-l', dest='layer', type=str, default=None, help='Layer name, if the datasource has several.')
+    parser.add_argument('--score-field', dest='score_field', type=str, default='proba', help='Field with the detection score.')
+    parser.add_argument('-o', dest='overlap', type=float, default=0.5,
+                        help='Fraction of the area of a detection covered by a later one to drop the later one (default 0.5).')
+    args = parser.parse_args()
+
+    start = time.time()
+    dataSources = []
+    layers = []
+    for detections in args.detections:
+        dataSource = ogr.Open(detections, 0)
+        if dataSource is None:
+            print('Unable to open %s' % detections)
+            sys.exit(1)
+        dataSources.append(dataSource)
+        layers.append(dataSource.GetLayer(args.layer) if args.layer else dataSource.GetLayer())
+
+    srs = equal_area_srs(layers, args.srs)
+    arrays = geometry_arrays(layers, srs, args.score_field, args.overlap)
+    if arrays['area'].size == 0:
+        print('No detections found in {}'.format(' '.join(args.detections)))
+        sys.exit(1)
+
+    summary = kiln_statistics(arrays)
+    summary['duplicates'] = arrays['duplicates']
+    summary['cellsize'] = args.cellsize
+    summary['srs'] = srs.ExportToProj4()
+    with open(args.output + '.json', 'w') as outfile:
+        json.dump(summary, outfile, indent=2)
+
+    counts, areas, geoTrans = density_grid(arrays, args.cellsize)
+    raster.savecompressed(args.output, [counts, areas], geoTrans, srs.ExportToWkt())
+
+    print(json.dumps(summary, indent=2))
+    end = time.time()
+    print("Finish!!! :). Execution time: {}".format(end - start))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
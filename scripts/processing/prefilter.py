@@ -0,0 +1,455 @@
+__author__ = "Laura Martinez Sanchez"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "lmartisa@gmail.com"
+
+import sys
+import os
+syspath = "{}/code/scripts/GDAL-python".format(os.environ['DIR'])
+sys.path.append(syspath)
+import shapefile
+import raster
+import rasteraccess
+import incremental
+from osgeo import ogr, gdal
+import numpy as np
+import multiprocessing as mp
+import argparse
+import json
+import time
+
+# Cheap screening of the tiles before Faster R-CNN. Each tile is summarised by a few
+# intensity and texture statistics computed on a downsampled read (GDAL uses the
+# overviews when the tile has them) and scored by a logistic regression trained with
+# the tiles with annotations as positives and the tiles without annotations as negatives.
+# The skip threshold is set on a validation split to keep a target recall of kilns.
+
+
+def tile_features(path, size = 64):
+    """
+    Computes the features of a tile on a size x size averaged read of all its bands.
+
+    Args:
+        path (str): Path to the tile.
+        size (int): Size in pixels of the downsampled read.
+
+    Returns:
+        numpy array: Feature vector, intensity statistics, gradient and laplacian
+        statistics of the mean of the bands, fraction of dark pixels and mean of each band.
+    """
+    img = rasteraccess.open_raster(path)
+    array = img.read(buf_size = (size, size), resample_alg = gdal.GRIORA_Average).astype(np.float32)
+    if array.ndim == 2:
+        array = array[np.newaxis]
+
+    gray = array.mean(axis=0)
+    gx = np.abs(np.diff(gray, axis=1))
+    gy = np.abs(np.diff(gray, axis=0))
+    lap = np.abs(4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:])
+    p5, p50, p95 = np.percentile(gray, [5, 50, 95])
+    std = gray.std()
+
+    features = [gray.mean(), std, p5, p50, p95, p95 - p5,
+                gx.mean(), gy.mean(), gx.std(), gy.std(), lap.mean(), lap.std(),
+                (gray < p50 - 2 * std).mean()]
+    features += list(array.reshape(array.shape[0], -1).mean(axis=1))
+    return np.array(features, dtype=np.float64)
+
+
+def _tile_features(args):
+    return tile_features(*args)
+
+
+def features_matrix(paths, size = 64, jobs = 1):
+    """
+    Computes the features of a list of tiles, in parallel if jobs > 1.
+
+    Args:
+        paths (list): Paths to the tiles.
+        size (int): Size in pixels of the downsampled read.
+        jobs (int): Number of processes.
+
+    Returns:
+        numpy array: Features with shape (len(paths), number of features).
+    """
+    if jobs > 1:
+        pool = mp.Pool(jobs)
+        features = pool.map(_tile_features, [(path, size) for path in paths])
+        pool.close()
+    else:
+        features = [tile_features(path, size) for path in paths]
+    return np.vstack(features)
+
+
+def coco_tiles(json_path, img_dir):
+    """
+    Lists the images of a COCO json with the number of annotations of each one.
+
+    Args:
+        json_path (str): Path to the COCO json.
+        img_dir (str): Folder with the images.
+
+    Returns:
+        dict: {image path: number of annotations}
+    """
+    with open(json_path) as json_file:
+        data = json.load(json_file)
+    names = {image['id']: os.path.join(img_dir, image['file_name']) for image in data['images']}
+    counts = {path: 0 for path in names.values()}
+    for annotation in data['annotations']:
+        counts[names[annotation['image_id']]] += 1
+    return counts
+
+
+def train_logistic(X, y, weights, l2 = 1e-3, iters = 1000, lr = 0.5):
+    """
+    Fits a L2 regularised logistic regression by gradient descent on the
+    standardised features. Positives and negatives get the same total weight.
+
+    Args:
+        X (numpy array): Features (n, f).
+        y (numpy array): Labels, 1 for tiles with kilns.
+        weights (numpy array): Weight of each sample.
+        l2 (float): Regularisation strength.
+        iters (int): Number of iterations.
+        lr (float): Learning rate.
+
+    Returns:
+        dict: mean, std, coef and intercept of the model.
+    """
+    mean = X.mean(axis=0)
+    std = X.std(axis=0)
+    std[std == 0] = 1.0
+    Xs = (X - mean) / std
+
+    w = weights.astype(np.float64).copy()
+    w[y == 1] /= w[y == 1].sum()
+    w[y == 0] /= w[y == 0].sum()
+    w /= w.sum()
+
+    coef = np.zeros(X.shape[1])
+    intercept = 0.0
+    for i in range(iters):
+        p = 1.0 / (1.0 + np.exp(-(Xs.dot(coef) + intercept)))
+        error = w * (p - y)
+        coef -= lr * (Xs.T.dot(error) + l2 * coef)
+        intercept -= lr * error.sum()
+    return {'mean': mean.tolist(), 'std': std.tolist(), 'coef': coef.tolist(), 'intercept': intercept}
+
+
+def predict(model, X):
+    """
+    Scores the tiles with the logistic model.
+
+    Args:
+        model (dict): Model as returned by train_logistic or load_model.
+        X (numpy array): Features (n, f).
+
+    Returns:
+        numpy array: Probability of each tile to contain kilns.
+    """
+    Xs = (X - np.array(model['mean'])) / np.array(model['std'])
+    return 1.0 / (1.0 + np.exp(-(Xs.dot(np.array(model['coef'])) + model['intercept'])))
+
+
+def select_threshold(scores, weights, recall):
+    """
+    Highest threshold that keeps at least the target recall of the positives.
+
+    Args:
+        scores (numpy array): Scores of the positive tiles.
+        weights (numpy array): Number of kilns of each positive tile.
+        recall (float): Target recall in (0, 1].
+
+    Returns:
+        float: Threshold, tiles with a score below it are skipped.
+    """
+    order = np.argsort(-scores)
+    kept = np.cumsum(weights[order]) / weights.sum()
+    index = min(np.searchsorted(kept, recall - 1e-12), len(kept) - 1)
+    return float(scores[order][index])
+
+
+def load_model(path):
+    """
+    Loads a prefilter saved with save_model.
+    """
+    with open(path) as json_file:
+        return json.load(json_file)
+
+
+def save_model(model, path):
+    """
+    Saves the prefilter, its threshold and validation report as json.
+    """
+    with open(path, 'w') as outfile:
+        json.dump(model, outfile, indent=1)
+
+
+def train(json_path, img_dir, negatives, recall = 0.99, val = 0.2, size = 64, jobs = 1, seed = 0, max_negatives = 5000):
+    """
+    Trains the prefilter and sets its threshold on a validation split. The negatives
+    are a random sample of at most max_negatives tiles, the list of tiles without
+    annotations holds almost every tile of the country.
+
+    Args:
+        json_path (str): COCO json with the annotated tiles (positives).
+        img_dir (str): Folder with the annotated tiles.
+        negatives (list): Paths to tiles without annotations.
+        recall (float): Target recall of kilns kept after the prefilter.
+        val (float): Fraction of the tiles kept aside to set the threshold.
+        size (int): Size in pixels of the downsampled read.
+        jobs (int): Number of processes to compute the features.
+        seed (int): Seed of the sample of negatives and of the split.
+        max_negatives (int): Maximum number of negatives read, None reads all of them.
+
+    Returns:
+        dict: The model with its threshold and the validation report.
+    """
+    rng = np.random.RandomState(seed)
+    negatives = list(negatives)
+    if max_negatives is not None and len(negatives) > max_negatives:
+        negatives = [negatives[i] for i in sorted(rng.choice(len(negatives), max_negatives, replace=False))]
+        print("{} negatives sampled to train the prefilter".format(max_negatives))
+
+    counts = coco_tiles(json_path, img_dir)
+    positives = [path for path, n in counts.items() if n > 0]
+    paths = positives + list(negatives)
+    y = np.array([1] * len(positives) + [0] * len(negatives))
+    weights = np.array([counts[path] for path in positives] + [1] * len(negatives), dtype=np.float64)
+    X = features_matrix(paths, size, jobs)
+
+    is_val = rng.rand(len(paths)) < val
+    model = train_logistic(X[~is_val], y[~is_val], weights[~is_val])
+    scores = predict(model, X[is_val])
+
+    pos = y[is_val] == 1
+    if not pos.any():
+        raise ValueError("no annotated tiles in the validation split, increase the fraction of validation")
+    model['threshold'] = select_threshold(scores[pos], weights[is_val][pos], recall)
+    model['size'] = size
+    model['recall_target'] = recall
+    kept = scores >= model['threshold']
+    model['validation'] = {'tiles': int(is_val.sum()),
+                           'skipped': float(1.0 - kept.mean()),
+                           'negatives_skipped': float(1.0 - kept[~pos].mean()) if (~pos).any() else None,
+                           'kiln_recall': float(weights[is_val][pos & kept].sum() / weights[is_val][pos].sum())}
+    return model
+
+
+def filter_tiles(model, tiles, jobs = 1):
+    """
+    Splits the tiles in the ones to run through the detector and the skipped ones.
+
+    Args:
+        model (dict): Trained prefilter.
+        tiles (list): Paths to the tiles.
+        jobs (int): Number of processes to compute the features.
+
+    Returns:
+        keep (list): Paths of the tiles to run through the detector.
+        skipped (list): (path, score) of the skipped tiles.
+    """
+    if len(tiles) == 0:
+        return [], []
+    scores = predict(model, features_matrix(tiles, model['size'], jobs))
+    keep = [tile for tile, score in zip(tiles, scores) if score >= model['threshold']]
+    skipped = [(tile, float(score)) for tile, score in zip(tiles, scores) if score < model['threshold']]
+    print("{} of {} tiles skipped by the prefilter".format(len(skipped), len(tiles)))
+    return keep, skipped
+
+
+def screen_tiles(catalog, model_path, tiles, jobs = 1):
+    """
+    As filter_tiles, but the skip decisions are kept in the catalog by the checksum of
+    the scene of the tile and the sha256 of the prefilter, so a skipped tile is only
+    scored again when its scene or the prefilter change. Tiles whose scene is not in
+    the catalog are scored and never recorded.
+
+    Args:
+        catalog (dict): The catalog of incremental.py, updated in place.
+        model_path (str): Path to the prefilter json.
+        tiles (list): Paths to the tiles.
+        jobs (int): Number of processes to compute the features.
+
+    Returns:
+        keep (list): Paths of the tiles to run through the detector.
+        skipped (list): (path, score) of the skipped tiles.
+    """
+    digest = incremental.file_checksum(model_path)
+    scenes = incremental.scene_index(catalog['scenes'])
+    screened = catalog.setdefault('screened', {}).setdefault(model_path, {'sha256': digest, 'tiles': {}})
+    if screened['sha256'] != digest:
+        screened['sha256'] = digest
+        screened['tiles'] = {}
+    records = screened['tiles']
+
+    skipped = []
+    todo = []
+    for tile in tiles:
+        scene = scenes.get(incremental.scene_name(tile))
+        record = records.get(os.path.basename(tile))
+        if scene is not None and record is not None and record['checksum'] == scene['checksum']:
+            skipped.append((tile, record['score']))
+        else:
+            todo.append(tile)
+    print("{} tiles skipped by the prefilter in a previous run".format(len(skipped)))
+
+    keep, new = filter_tiles(load_model(model_path), todo, jobs)
+    for tile in keep:
+        records.pop(os.path.basename(tile), None)
+    for tile, score in new:
+        scene = scenes.get(incremental.scene_name(tile))
+        if scene is not None:
+            records[os.path.basename(tile)] = {'checksum': scene['checksum'], 'score': score}
+    return keep, skipped + new
+
+
+def detections_in_tiles(layer, tiles):
+    """
+    FIDs of the detections that intersect the extent of any of the tiles.
+
+    Args:
+        layer (ogr.Layer): Detections, in the projection of the tiles.
+        tiles (list): Paths to the tiles.
+
+    Returns:
+        set: FIDs of the detections.
+    """
+    fids = set()
+    for tile in tiles:
+        geoTrans, proj, img = raster.readraster(tile, cache = False)
+        xLeft, xRight, yTop, yBottom = raster.GetPointsRaster(img)
+        img = None
+        layer.SetSpatialFilter(raster.BBoxAsgeom(xLeft, xRight, yTop, yBottom))
+        fids.update(feature.GetFID() for feature in layer)
+        layer.ResetReading()
+    layer.SetSpatialFilter(None)
+    return fids
+
+
+def evaluate(model, tiles, json_path = None, detections = None, jobs = 1):
+    """
+    Measures the recall lost by the prefilter on a validation set of tiles.
+
+    Args:
+        model (dict): Trained prefilter.
+        tiles (list): Paths to the validation tiles, with and without annotations.
+        json_path (str): Optional COCO json of the validation tiles, to count the
+            annotated kilns that fall in skipped tiles.
+        detections (str): Optional shapefile with the output of the full detector on
+            the validation tiles (FinalGeoms.shp), to count the detections that would
+            have been lost. A detection on the overlap of a kept tile is not lost.
+
+    Returns:
+        dict: Report of skipped tiles and recall loss.
+    """
+    keep, skipped = filter_tiles(model, tiles, jobs)
+    skipped = [tile for tile, score in skipped]
+    report = {'tiles': len(tiles), 'skipped': len(skipped),
+              'skipped_fraction': len(skipped) / float(len(tiles)) if tiles else 0.0}
+
+    if json_path is not None:
+        counts = coco_tiles(json_path, '')
+        counts = {os.path.basename(path): n for path, n in counts.items()}
+        total = sum(counts.get(os.path.basename(tile), 0) for tile in tiles)
+        lost = sum(counts.get(os.path.basename(tile), 0) for tile in skipped)
+        report['annotations'] = total
+        report['annotations_lost'] = lost
+        report['annotation_recall_loss'] = lost / float(total) if total else 0.0
+
+    if detections is not None:
+        layer, driver, dataSource = shapefile.openshp(detections, 0)
+        kept_fids = detections_in_tiles(layer, keep)
+        lost_fids = detections_in_tiles(layer, skipped) - kept_fids
+        total = len(kept_fids | lost_fids)
+        report['detections'] = total
+        report['detections_lost'] = len(lost_fids)
+        report['detector_recall_loss'] = len(lost_fids) / float(total) if total else 0.0
+        dataSource = None
+    return report
+
+
+def read_list(path):
+    """
+    Reads a list of paths, one per line, as the csv lists of the chain.
+    """
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_skipped(path, skipped):
+    """
+    Writes the skipped tiles with their score as path,score lines.
+    """
+    with open(path, 'w') as f:
+        for tile, score in skipped:
+            f.write('{},{}\n'.format(tile, score))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prefilter to skip kiln-free tiles before the detector.')
+    parser.add_argument('-j', dest='jobs', type=int, default=1, help='Number of processes to compute the features.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    tr = subparsers.add_parser('train', help='Train the prefilter from the annotated tiles.')
+    tr.add_argument('annotations', type=str, help='COCO json with the annotated tiles.')
+    tr.add_argument('images', type=str, help='Folder with the annotated tiles.')
+    tr.add_argument('negatives', type=str, help='List of tiles without annotations.')
+    tr.add_argument('model', type=str, help='Where to save the prefilter json.')
+    tr.add_argument('-r', dest='recall', type=float, default=0.99, help='Target recall of kilns (default 0.99).')
+    tr.add_argument('-v', dest='val', type=float, default=0.2, help='Fraction of tiles to set the threshold (default 0.2).')
+    tr.add_argument('--size', type=int, default=64, help='Size in pixels of the downsampled read (default 64).')
+    tr.add_argument('-n', dest='max_negatives', type=int, default=5000, help='Negatives sampled to train (default 5000).')
+    tr.add_argument('--force', action='store_true',
+                    help='Overwrite an existing prefilter, the skip decisions kept in the catalog are reset.')
+
+    fi = subparsers.add_parser('filter', help='Split a list of tiles into kept and skipped.')
+    fi.add_argument('model', type=str, help='Prefilter json.')
+    fi.add_argument('tiles', type=str, help='List of tiles.')
+    fi.add_argument('keep', type=str, help='Where to write the list of tiles to run through the detector.')
+    fi.add_argument('skipped', type=str, help='Where to write the skipped tiles and their score.')
+    fi.add_argument('--catalog', type=str, default=None, help='Catalog json of incremental.py to keep the skip decisions.')
+
+    ev = subparsers.add_parser('evaluate', help='Recall lost by the prefilter on a validation set.')
+    ev.add_argument('model', type=str, help='Prefilter json.')
+    ev.add_argument('tiles', type=str, help='List of validation tiles.')
+    ev.add_argument('--annotations', type=str, default=None, help='COCO json of the validation tiles.')
+    ev.add_argument('--detections', type=str, default=None, help='Output of the full detector on the validation tiles.')
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    start = time.time()
+    if args.command == 'train':
+        if os.path.exists(args.model) and not args.force:
+            print("{} exists, use --force to train it again".format(args.model))
+            sys.exit(1)
+        model = train(args.annotations, args.images, read_list(args.negatives), args.recall, args.val, args.size,
+                      args.jobs, max_negatives = args.max_negatives)
+        save_model(model, args.model)
+        print(json.dumps(model['validation'], indent=2))
+    elif args.command == 'filter':
+        if args.catalog is not None:
+            catalog = incremental.load_catalog(args.catalog)
+            keep, skipped = screen_tiles(catalog, args.model, read_list(args.tiles), args.jobs)
+            incremental.save_catalog(catalog, args.catalog)
+        else:
+            keep, skipped = filter_tiles(load_model(args.model), read_list(args.tiles), args.jobs)
+        with open(args.keep, 'w') as f:
+            for tile in keep:
+                f.write(tile + '\n')
+        write_skipped(args.skipped, skipped)
+    else:
+        report = evaluate(load_model(args.model), read_list(args.tiles), args.annotations, args.detections, args.jobs)
+        print(json.dumps(report, indent=2))
+
+    end = time.time()
+    print("Finish!!! :). Execution time: {}".format(end - start))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()